@@ -1,19 +1,25 @@
 from flask import Flask, request, jsonify, redirect
 from flask_sqlalchemy import SQLAlchemy
 import string
-import random
-import re
+import threading
+import time
+import atexit
+import queue
 import os
-from google.cloud.sql.connector import Connector
+import ipaddress
 import sqlalchemy
-from google.cloud import bigquery
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import urlsplit
 
 def get_base_url():
     # Check if we have forwarded headers (production with reverse proxy)
-    if request.headers.get('X-Forwarded-Proto') and request.headers.get('Host'):
-        proto = request.headers.get('X-Forwarded-Proto')
-        host = request.headers.get('Host')
+    proto = request.headers.get('X-Forwarded-Proto')
+    host = request.headers.get('Host')
+    if proto and host:
         return f"{proto}://{host}"
 
     # Fallback to request.url_root for development
@@ -21,16 +27,18 @@ def get_base_url():
 
 app = Flask(__name__)
 
+ENVIRONMENT = os.getenv('ENVIRONMENT', 'development')
+
+ALLOWED_ORIGINS = frozenset((
+    'https://url-shortener-464622.web.app',
+    'http://localhost:5173'
+))
+
 
 @app.after_request
 def after_request(response):
     origin = request.headers.get('Origin')
-    allowed_origins = [
-        'https://url-shortener-464622.web.app',
-        'http://localhost:5173'
-    ]
-
-    if origin in allowed_origins:
+    if origin in ALLOWED_ORIGINS:
         response.headers['Access-Control-Allow-Origin'] = origin
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
@@ -40,6 +48,8 @@ def after_request(response):
 
 def get_connection_creator():
     """Returns a connection creator function for production database"""
+    # Imported here so development never loads the Cloud SQL connector
+    from google.cloud.sql.connector import Connector
     connector = Connector()
 
     def getconn():
@@ -55,25 +65,43 @@ def get_connection_creator():
     return getconn
 
 
-if os.getenv('ENVIRONMENT') == 'production':
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the writer; NORMAL syncs once per checkpoint, not per commit"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MiB
+    cursor.close()
+
+
+QUERY_CACHE_SIZE = 1200
+
+if ENVIRONMENT == 'production':
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'pool_size': 5,
+        'pool_size': 20,
         'pool_timeout': 30,
-        'pool_recycle': -1,
-        'max_overflow': 2,
-        'pool_pre_ping': True,
+        'pool_recycle': 1800,  # recycle before Cloud SQL drops idle connections, instead of pinging
+        'max_overflow': 10,
+        'pool_pre_ping': False,
         'pool_reset_on_return': None,
+        'query_cache_size': QUERY_CACHE_SIZE,
         'creator': get_connection_creator()
     }
     app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+pg8000://'
 else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///urls.db'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'query_cache_size': QUERY_CACHE_SIZE}
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+        'DATABASE_URL', 'sqlite:///urls.db?check_same_thread=False')
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
-# Initialize BigQuery client
-bq_client = bigquery.Client() if os.getenv('ENVIRONMENT') == 'production' else None
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        sqlalchemy.event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+# BigQuery logging is production-only; the client is created lazily by _bq_worker
+bq_enabled = ENVIRONMENT == 'production'
 
 
 class URL(db.Model):
@@ -83,57 +111,320 @@ class URL(db.Model):
     clicks = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
+    # Postgres caps btree entries at about 2.7kB, so long URLs are deduplicated on their md5 there
+    __table_args__ = (
+        db.Index('ix_url_original_url_md5', db.func.md5(original_url), unique=True)
+        .ddl_if(dialect='postgresql'),
+        db.Index('ix_url_original_url', original_url, unique=True).ddl_if(dialect='sqlite'),
+    )
+
+
+class ShortCodeAlias(db.Model):
+    """Short codes retired when migrate.py merged duplicate URLs; they resolve to the kept row"""
+    short_code = db.Column(db.String(10), primary_key=True)
+    url_id = db.Column(db.Integer, db.ForeignKey('url.id'), nullable=False)
+
+
+_ORIGINAL_URL_INDEX = 'ix_url_original_url_md5' if ENVIRONMENT == 'production' else 'ix_url_original_url'
+
+# Set once the unique original_url index exists; the shorten upsert can't run without it
+schema_ready = False
+# Codes kept as aliases by migrate.py; new URLs must not be given one of them
+_retired_codes = frozenset()
+
+
+class DuplicateURLsError(RuntimeError):
+    pass
+
+
+def create_schema():
+    """Creates missing tables, then the unique original_url index the shorten upsert relies on.
+    create_all skips indexes on tables that already exist, so older databases get it here.
+    Raises DuplicateURLsError instead if rows still share an original_url; see migrate.py."""
+    global schema_ready, _retired_codes
+    db.create_all()
+
+    index = next(ix for ix in URL.__table__.indexes if ix.name == _ORIGINAL_URL_INDEX)
+    with db.engine.begin() as conn:
+        # SQLite answers the inspector's PRAGMAs from a cached schema that can be stale after
+        # DDL on another connection (e.g. migrate.py); a real read refreshes it first
+        conn.execute(db.text('SELECT 1 FROM url LIMIT 1'))
+        if not any(ix['name'] == index.name for ix in sqlalchemy.inspect(conn).get_indexes('url')):
+            duplicates = conn.execute(db.text(
+                'SELECT 1 FROM url GROUP BY original_url HAVING COUNT(*) > 1 LIMIT 1'
+            )).first()
+            if duplicates:
+                raise DuplicateURLsError(
+                    'url has rows sharing an original_url, so its unique index cannot be created. '
+                    'Run `python migrate.py` to merge them.'
+                )
+            index.create(conn)
+        _retired_codes = frozenset(conn.execute(db.select(ShortCodeAlias.short_code)).scalars())
+    schema_ready = True
+
 
 # Create tables - with error handling for production startup
 with app.app_context():
     try:
-        db.create_all()
+        create_schema()
         print("✅ Database tables created successfully")
+    except DuplicateURLsError as e:
+        print(f"❌ {e} /api/shorten is disabled until then.")
     except Exception as e:
         print(f"⚠️ Database table creation failed: {e}")
-        if os.getenv('ENVIRONMENT') == 'production':
+        if ENVIRONMENT == 'production':
             print("🔄 App will continue running - tables can be created via /api/init-db endpoint")
         else:
             raise  # Re-raise in development
 
 
+# Hot-path statements are built once so SQLAlchemy's compiled cache is hit on every execution
+_urls = URL.__table__
+if ENVIRONMENT == 'production':
+    _insert, _original_url_key = pg_insert, db.func.md5(_urls.c.original_url)
+else:
+    _insert, _original_url_key = sqlite_insert, _urls.c.original_url
+
+_SELECT_URL_BY_CODE = db.select(URL.id, URL.original_url).where(
+    URL.short_code == sqlalchemy.bindparam('code'))
+_SELECT_STATS_BY_CODE = db.select(URL.id, URL.original_url, URL.clicks, URL.created_at).where(
+    URL.short_code == sqlalchemy.bindparam('code'))
+# Fallbacks for short codes retired by migrate.py, only run when the lookups above miss
+_SELECT_URL_BY_ALIAS = db.select(URL.id, URL.original_url).join(
+    ShortCodeAlias, ShortCodeAlias.url_id == URL.id
+).where(ShortCodeAlias.short_code == sqlalchemy.bindparam('code'))
+_SELECT_STATS_BY_ALIAS = db.select(URL.id, URL.original_url, URL.clicks, URL.created_at).join(
+    ShortCodeAlias, ShortCodeAlias.url_id == URL.id
+).where(ShortCodeAlias.short_code == sqlalchemy.bindparam('code'))
+# INSERT ... ON CONFLICT on the original_url index that returns the stored short code
+_UPSERT_URL = _insert(_urls).values(
+    original_url=sqlalchemy.bindparam('url'), short_code=sqlalchemy.bindparam('code'))
+_UPSERT_URL = _UPSERT_URL.on_conflict_do_update(
+    index_elements=[_original_url_key],
+    set_={'original_url': _UPSERT_URL.excluded.original_url},
+    # A different URL whose md5 collides must not be overwritten; no row comes back instead
+    where=_urls.c.original_url == _UPSERT_URL.excluded.original_url
+).returning(_urls.c.short_code)
+_INCREMENT_CLICKS = sqlalchemy.update(_urls).where(
+    _urls.c.id == sqlalchemy.bindparam('url_id')
+).values(clicks=_urls.c.clicks + sqlalchemy.bindparam('count'))
+
+
+SHORT_CODE_ATTEMPTS = 5
+
+
+_ALPHABET = (string.ascii_letters + string.digits + '-_').encode()
+# Maps each random byte onto the 64-character URL-safe alphabet (256 is a multiple of 64, so no bias)
+_SHORT_CODE_TABLE = bytes(_ALPHABET[i & 63] for i in range(256))
+
+
 def generate_short_code(length=6):
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
+    return os.urandom(length).translate(_SHORT_CODE_TABLE).decode()
+
+
+_HOST_CHARS = frozenset(string.ascii_lowercase + string.digits + '-.')
+
+
+def _is_valid_host(host):
+    if host == 'localhost':
+        return True
+    if not host.isascii() or not set(host) <= _HOST_CHARS:
+        return False
+
+    labels = host[:-1].split('.') if host.endswith('.') else host.split('.')
+    if labels[-1].isdigit():
+        try:
+            ipaddress.IPv4Address(host)
+        except ValueError:
+            return False
+        return True
+
+    if len(labels) < 2 or not (2 <= len(labels[-1]) <= 6 and labels[-1].isalpha()):
+        return False
+    for label in labels:
+        if not 0 < len(label) <= 63 or label[0] == '-' or label[-1] == '-':
+            return False
+    return True
 
 
 def is_valid_url(url):
-    pattern = re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    return pattern.match(url) is not None
+    # Plain string checks instead of a regex: linear in the URL length, no backtracking
+    if not url[:8].lower().startswith(('http://', 'https://')) or url.split() != [url]:
+        return False
 
+    try:
+        parts = urlsplit(url)
+    except ValueError:  # e.g. an unterminated IPv6 bracket
+        return False
+    if parts.scheme not in ('http', 'https') or not parts.netloc or '@' in parts.netloc:
+        return False
+
+    host, sep, port = parts.netloc.partition(':')
+    if sep and not (port.isascii() and port.isdigit()):
+        return False
+    return _is_valid_host(host.lower())
+
+
+CLICK_FLUSH_INTERVAL = 5  # seconds
+
+_pending_clicks = Counter()
+# The batch flush_clicks is writing; still counted by get_stats until it commits
+_flushing_clicks = Counter()
+_pending_clicks_lock = threading.Lock()
+_last_click_flush = time.monotonic()
+
+
+def record_click(url_id):
+    with _pending_clicks_lock:
+        _pending_clicks[url_id] += 1
+        flush_due = time.monotonic() - _last_click_flush >= CLICK_FLUSH_INTERVAL
+
+    # Cloud Run throttles CPU between requests, so the background worker alone may never
+    # get to run; flushing from the request path keeps counts moving either way
+    if flush_due:
+        flush_clicks()
+
+
+def unflushed_clicks(url_id):
+    with _pending_clicks_lock:
+        return _pending_clicks.get(url_id, 0) + _flushing_clicks.get(url_id, 0)
+
+
+def flush_clicks():
+    """Writes buffered click counts to the database in a single transaction"""
+    global _pending_clicks, _flushing_clicks, _last_click_flush
+    with _pending_clicks_lock:
+        # Skip if there's nothing to write or another flush is still in flight
+        if not _pending_clicks or _flushing_clicks:
+            return
+        _last_click_flush = time.monotonic()
+        pending = _flushing_clicks = _pending_clicks
+        _pending_clicks = Counter()
+
+    with app.app_context():
+        try:
+            db.session.execute(
+                _INCREMENT_CLICKS,
+                [{'url_id': url_id, 'count': count} for url_id, count in pending.items()]
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Click flush error: {e}")
+            # Keep the counts so the next flush retries them
+            with _pending_clicks_lock:
+                _pending_clicks.update(pending)
+                _flushing_clicks = Counter()
+            return
+
+    with _pending_clicks_lock:
+        _flushing_clicks = Counter()
+
+
+def _click_flush_worker():
+    while True:
+        time.sleep(CLICK_FLUSH_INTERVAL)
+        flush_clicks()
 
-def log_click_event(short_code, user_agent, ip_address):
-    if not bq_client:
-        return
 
-    table_id = f"{os.getenv('GOOGLE_CLOUD_PROJECT')}.analytics.url_clicks"
+threading.Thread(target=_click_flush_worker, daemon=True).start()
+atexit.register(flush_clicks)
 
-    rows_to_insert = [{
-        "short_code": short_code,
-        "timestamp": datetime.now(datetime.UTC).isoformat(),
-        "user_agent": user_agent,
-        "ip_address": ip_address
-    }]
 
+BQ_BATCH_SIZE = 500
+BQ_BATCH_INTERVAL = 1  # seconds
+BQ_TABLE_ID = f"{os.getenv('GOOGLE_CLOUD_PROJECT')}.analytics.url_clicks"
+
+_bq_queue = queue.Queue(maxsize=10000)
+_bq_client = None
+
+
+def _insert_click_rows(rows_to_insert):
     try:
-        errors = bq_client.insert_rows_json(table_id, rows_to_insert)
+        errors = _bq_client.insert_rows_json(BQ_TABLE_ID, rows_to_insert)
         if errors:
             print(f"BigQuery insert errors: {errors}")
     except Exception as e:
         print(f"BigQuery error: {e}")
 
 
+def _bq_worker():
+    """Streams queued click events to BigQuery, up to BQ_BATCH_SIZE rows or
+    BQ_BATCH_INTERVAL seconds' worth per insert"""
+    global bq_enabled, _bq_client
+
+    # Imported off the request path so cold starts don't wait on the google-cloud stack
+    try:
+        from google.cloud import bigquery
+        _bq_client = bigquery.Client()
+    except Exception as e:
+        print(f"BigQuery client initialization failed, click logging disabled: {e}")
+        bq_enabled = False
+        return
+
+    while True:
+        rows_to_insert = [_bq_queue.get()]
+        deadline = time.monotonic() + BQ_BATCH_INTERVAL
+        while len(rows_to_insert) < BQ_BATCH_SIZE:
+            try:
+                rows_to_insert.append(_bq_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        _insert_click_rows(rows_to_insert)
+
+
+def drain_click_events():
+    """Sends whatever is still queued. With Cloud Run throttling CPU between requests the
+    worker can fall behind, so this runs at shutdown to avoid dropping those events."""
+    if _bq_client is None:
+        return
+
+    rows_to_insert = []
+    while True:
+        try:
+            rows_to_insert.append(_bq_queue.get_nowait())
+        except queue.Empty:
+            break
+    for start in range(0, len(rows_to_insert), BQ_BATCH_SIZE):
+        _insert_click_rows(rows_to_insert[start:start + BQ_BATCH_SIZE])
+
+
+if bq_enabled:
+    threading.Thread(target=_bq_worker, daemon=True).start()
+    atexit.register(drain_click_events)
+
+
+_timestamp_second = (0, '')
+
+
+def _click_timestamp():
+    """UTC ISO-8601 timestamp with millisecond precision. The date and time part
+    is only reformatted when the second changes."""
+    global _timestamp_second
+    now = time.time()
+    second, prefix = _timestamp_second
+    if int(now) != second:
+        second = int(now)
+        prefix = datetime.fromtimestamp(second, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+        _timestamp_second = (second, prefix)
+    return f"{prefix}.{int((now - second) * 1000):03d}+00:00"
+
+
+def log_click_event(short_code, user_agent, ip_address):
+    if not bq_enabled:
+        return
+
+    try:
+        _bq_queue.put_nowait({
+            "short_code": short_code,
+            "timestamp": _click_timestamp(),
+            "user_agent": user_agent,
+            "ip_address": ip_address
+        })
+    except queue.Full:
+        print("BigQuery queue full, dropping click event")
+
+
 @app.route('/api/shorten', methods=['OPTIONS'])
 def options_shorten():
     return '', 200
@@ -141,32 +432,38 @@ def options_shorten():
 
 @app.route('/api/shorten', methods=['POST'])
 def shorten_url():
-    data = request.get_json()
-    original_url = data.get('url')
+    # Malformed or non-object bodies fall through to the 'URL is required' error
+    data = request.get_json(silent=True, cache=False)
+    original_url = data.get('url') if isinstance(data, dict) else None
 
     if not original_url:
         return jsonify({'error': 'URL is required'}), 400
 
-    if not is_valid_url(original_url):
+    if not isinstance(original_url, str) or not is_valid_url(original_url):
         return jsonify({'error': 'Invalid URL format'}), 400
 
-    # Check if URL already exists
-    existing = URL.query.filter_by(original_url=original_url).first()
-    if existing:
-        return jsonify({
-            'short_url': f'{get_base_url()}/{existing.short_code}',
-            'short_code': existing.short_code
-        })
-
-    # Generate unique short code
-    while True:
-        short_code = generate_short_code()
-        if not URL.query.filter_by(short_code=short_code).first():
+    if not schema_ready:
+        return jsonify({'error': 'Database needs migrating before URLs can be shortened'}), 503
+
+    # One round trip: insert a new row, or get back the code already stored for this URL
+    for attempt in range(SHORT_CODE_ATTEMPTS):
+        code = generate_short_code()
+        while code in _retired_codes:
+            code = generate_short_code()
+        try:
+            short_code = db.session.execute(
+                _UPSERT_URL, {'url': original_url, 'code': code}
+            ).scalar()
+            db.session.commit()
             break
+        except sqlalchemy.exc.IntegrityError:
+            # short_code collision; try again with a fresh code
+            db.session.rollback()
+            if attempt == SHORT_CODE_ATTEMPTS - 1:
+                raise
 
-    new_url = URL(original_url=original_url, short_code=short_code)
-    db.session.add(new_url)
-    db.session.commit()
+    if short_code is None:
+        return jsonify({'error': 'URL conflicts with an existing short URL'}), 409
 
     return jsonify({
         'short_url': f'{get_base_url()}/{short_code}',
@@ -174,15 +471,34 @@ def shorten_url():
     })
 
 
+REDIRECT_MAX_AGE = 86400  # seconds
+REDIRECT_CACHE_SIZE = int(os.getenv('REDIRECT_CACHE_SIZE', 8192))
+
+
+@lru_cache(maxsize=REDIRECT_CACHE_SIZE)
+def resolve_short_code(short_code):
+    """Returns (id, original_url) for a short code. Codes never change once created,
+    so hits are cached; misses raise LookupError so they are not.
+
+    An entry can hold a URL of up to 2048 characters, so the cache costs up to about
+    2.3 kB per entry per worker: roughly 20 MB at the default REDIRECT_CACHE_SIZE."""
+    params = {'code': short_code}
+    row = (db.session.execute(_SELECT_URL_BY_CODE, params).first()
+           or db.session.execute(_SELECT_URL_BY_ALIAS, params).first())
+    if row is None:
+        raise LookupError(short_code)
+    return tuple(row)
+
+
 @app.route('/<short_code>')
 def redirect_url(short_code):
-    url = URL.query.filter_by(short_code=short_code).first()
-    if not url:
+    try:
+        url_id, original_url = resolve_short_code(short_code)
+    except LookupError:
         return jsonify({'error': 'URL not found'}), 404
 
-    # Increment click counter
-    url.clicks += 1
-    db.session.commit()
+    # Counted in memory and written to the database by flush_clicks
+    record_click(url_id)
 
     # Log to BigQuery
     log_click_event(
@@ -191,19 +507,24 @@ def redirect_url(short_code):
         ip_address=request.remote_addr
     )
 
-    return redirect(url.original_url)
+    # Short codes never change, so browsers and CDNs may reuse the redirect
+    response = redirect(original_url, code=301)
+    response.headers['Cache-Control'] = f'public, max-age={REDIRECT_MAX_AGE}'
+    return response
 
 
 @app.route('/api/stats/<short_code>')
 def get_stats(short_code):
-    url = URL.query.filter_by(short_code=short_code).first()
+    params = {'code': short_code}
+    url = (db.session.execute(_SELECT_STATS_BY_CODE, params).first()
+           or db.session.execute(_SELECT_STATS_BY_ALIAS, params).first())
     if not url:
         return jsonify({'error': 'URL not found'}), 404
 
     return jsonify({
-        'short_code': url.short_code,
+        'short_code': short_code,
         'original_url': url.original_url,
-        'clicks': url.clicks,
+        'clicks': url.clicks + unflushed_clicks(url.id),
         'created_at': url.created_at.isoformat()
     })
 
@@ -212,7 +533,7 @@ def get_stats(short_code):
 def init_database():
     """Manual database initialization endpoint for production"""
     try:
-        db.create_all()
+        create_schema()
         return jsonify({
             'status': 'success',
             'message': 'Database tables created successfully'
@@ -236,7 +557,7 @@ def health_check():
     
     return jsonify({
         'status': 'ok',
-        'environment': os.getenv('ENVIRONMENT', 'development'),
+        'environment': ENVIRONMENT,
         'database': db_status
     })
 
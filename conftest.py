@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# Point the app at a throwaway SQLite file before app.py is imported
+os.environ.setdefault(
+    'DATABASE_URL',
+    f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}?check_same_thread=False"
+)
@@ -0,0 +1,38 @@
+"""Merges url rows that share an original_url, so the unique original_url index can be
+created on databases from before it existed. Each group keeps its oldest row; the other
+rows' short codes become aliases of it, so links already shared keep working.
+
+Run it once with the same environment as the app, then restart the app:
+
+    python migrate.py
+"""
+from app import app, db, create_schema, ShortCodeAlias
+
+
+def merge_duplicate_urls(conn):
+    """Folds every group of rows sharing an original_url into its oldest row.
+    Returns the number of rows merged away."""
+    ShortCodeAlias.__table__.create(conn, checkfirst=True)
+    kept = 'SELECT original_url, MIN(id) AS id FROM url GROUP BY original_url HAVING COUNT(*) > 1'
+
+    conn.execute(db.text(
+        'INSERT INTO short_code_alias (short_code, url_id) '
+        f'SELECT d.short_code, k.id FROM url d JOIN ({kept}) k '
+        'ON d.original_url = k.original_url WHERE d.id <> k.id'
+    ))
+    conn.execute(db.text(
+        'UPDATE url SET clicks = ('
+        '  SELECT SUM(COALESCE(d.clicks, 0)) FROM url d WHERE d.original_url = url.original_url'
+        f') WHERE id IN (SELECT id FROM ({kept}) k)'
+    ))
+    return conn.execute(db.text(
+        'DELETE FROM url WHERE id NOT IN (SELECT MIN(id) FROM url GROUP BY original_url)'
+    )).rowcount
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        with db.engine.begin() as conn:
+            merged = merge_duplicate_urls(conn)
+        create_schema()
+    print(f"✅ Merged {merged} duplicate URL rows; the original_url unique index is in place")